@@ -1,213 +1,516 @@
 import streamlit as st
+import asyncio
 import subprocess
-import json
+import mimetypes
 import os
 import re # Though yt-dlp handles most sanitization
+import shlex
+import shutil
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import parse_qs, urlparse
+from diskcache import Cache
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import format_bytes
+try:
+    from orjson import loads as json_loads
+except ImportError: # orjson is optional; json.loads accepts bytes just as well
+    from json import loads as json_loads
 
 # --- Configuration ---
 DOWNLOAD_DIR = "yt_dlp_downloads"  # Directory to store downloads on the server
+DEBUG = os.environ.get("APP_DEBUG") == "1"  # Show yt-dlp invocations in the UI
+MAX_DOWNLOAD_WORKERS = 6           # Number of yt-dlp downloads running in parallel, across all sessions
+METADATA_CACHE_DIR = os.path.join(".cache", "yt_meta")  # On-disk cache for playlist/video info
+METADATA_CACHE_TTL = 24 * 60 * 60  # Seconds before cached info is fetched again
+MEMORY_CACHE_TTL = 60 * 60         # Seconds info stays in Streamlit's in-memory cache in front of it
+DOWNLOAD_RECORDS_DIR = os.path.join(".cache", "yt_downloads")  # Which file each finished download produced
+DOWNLOAD_RECORD_TTL = 7 * 24 * 60 * 60  # Seconds a finished download is remembered across visits
+# yt-dlp -f selectors offered in the sidebar. The default grabs an already-muxed file, which
+# avoids downloading separate video/audio streams and merging them with ffmpeg.
+FORMAT_PRESETS = {
+    "Best single file (fast)": "best[ext=mp4]/best",
+    "Up to 1080p (merges with ffmpeg)": "bestvideo[height<=1080]+bestaudio/best[height<=1080]",
+    "Audio only": "bestaudio[ext=m4a]/bestaudio",
+}
+DEFAULT_FORMAT_PRESET = "Best single file (fast)"
+DETAILS_FETCH_CONCURRENCY = 8      # Max yt-dlp lookups running at once for "Fetch Details"
+# Don't fetch YouTube's DASH manifest; the regular stream list covers all presets above
+YT_DLP_EXTRACTOR_ARGS = {"youtube": {"skip": ["dash"]}}
+# Session settings shared by the in-process yt-dlp instance and every yt-dlp subprocess
+YT_DLP_COOKIE_FILE = os.environ.get("YT_DLP_COOKIE_FILE") # Optional Netscape-format cookies.txt
+YT_DLP_HTTP_HEADERS = {}           # Extra request headers, e.g. {"Accept-Language": "en-US,en"}
+# Prefix of the stdout line yt-dlp prints once a file has reached its final path (after_move)
+FILEPATH_MARKER = "filepath_READY="
+
+class DownloadError(Exception):
+    """Raised by the download helpers, which run on worker threads and cannot call st.* themselves."""
+
+class VideoInfoError(Exception):
+    """Raised by the metadata helpers so the caller reports the failure and it never gets cached."""
 
 # --- Helper Functions ---
 
+@st.cache_resource
+def get_metadata_cache():
+    """Returns the diskcache used to memoize metadata lookups (opened once per server process)."""
+    return Cache(METADATA_CACHE_DIR)
+
+METADATA_CACHE = get_metadata_cache()
+
+@st.cache_resource
+def get_download_records():
+    """
+    Returns the diskcache remembering finished downloads (opened once per server process).
+    Kept apart from METADATA_CACHE so clearing cached metadata doesn't forget downloaded files.
+    """
+    return Cache(DOWNLOAD_RECORDS_DIR)
+
+DOWNLOAD_RECORDS = get_download_records()
+
+def download_record_key(video_id, format_selector, playlist_url=None):
+    """
+    Returns the DOWNLOAD_RECORDS key for a video downloaded with format_selector, either on its own
+    or (playlist_url set) as part of that playlist, whose index is part of the file name.
+    """
+    return (video_id, format_selector, playlist_url)
+
+# Playlist URLs: youtube.com/playlist?list=<id> or youtube.com/watch?v=<id>&list=<id>
+_PLAYLIST_RE = re.compile(r"(?:youtube\.com/playlist\?list=|youtube\.com/watch\?v=[\w-]+&list=)([\w-]+)")
+
 def is_playlist(url):
     """Checks if the URL is likely a YouTube playlist."""
-    # More robust playlist detection regex
-    playlist_patterns = [
-        r"(?:https?:\/\/)?(?:www\.)?youtube\.com\/playlist\?list=([a-zA-Z0-9_-]+)",
-        r"(?:https?:\/\/)?(?:www\.)?youtube\.com\/watch\?v=([a-zA-Z0-9_-]+)&list=([a-zA-Z0-9_-]+)",
-    ]
-    for pattern in playlist_patterns:
-        if re.search(pattern, url):
-            return True
-    return "list=" in url # Fallback for simpler cases
+    return bool(_PLAYLIST_RE.search(url)) or "list=" in url # Fallback for simpler cases
+
+def get_playlist_id(url):
+    """Returns the playlist id from the URL's list= parameter, or None."""
+    return parse_qs(urlparse(url).query).get("list", [None])[0]
 
+def canonical_playlist_url(url):
+    """
+    Returns youtube.com/playlist?list=<id> for any URL carrying a list= id (or the URL unchanged),
+    so every URL pointing at the same playlist shares one get_playlist_info() cache entry.
+    """
+    playlist_id = get_playlist_id(url)
+    return f"https://www.youtube.com/playlist?list={playlist_id}" if playlist_id else url
 
+
+@st.cache_resource
+def get_info_downloader():
+    """
+    Returns the in-process yt-dlp instance used for metadata lookups, together with the
+    single-thread executor every lookup runs on (YoutubeDL is not thread-safe and is shared
+    across sessions, so the one worker serializes access to it).
+    """
+    params = {
+        "quiet": True,
+        "no_warnings": True,
+        # List playlist entries without visiting each video page; a top-level url result
+        # (e.g. a short link) is still followed to the video it points to
+        "extract_flat": "in_playlist",
+        "skip_download": True,
+        "socket_timeout": 30,
+        "extractor_args": YT_DLP_EXTRACTOR_ARGS,
+        "http_headers": YT_DLP_HTTP_HEADERS,
+    }
+    if YT_DLP_COOKIE_FILE:
+        params["cookiefile"] = YT_DLP_COOKIE_FILE
+    # Kept for the life of the server, so its HTTP connection pool and cookie jar are reused
+    # by every lookup instead of reconnecting to youtube.com each time
+    return YoutubeDL(params), ThreadPoolExecutor(max_workers=1)
+
+def run_info_lookup(lookup, timeout):
+    """
+    Runs lookup(ydl) on the shared metadata instance and waits at most timeout seconds for it,
+    counting any time spent queued behind other sessions' lookups.
+    Raises VideoInfoError if it doesn't finish in time; the lookup itself can't be interrupted,
+    but socket_timeout keeps it from hanging on a dead connection.
+    """
+    ydl, ydl_executor = get_info_downloader()
+    future = ydl_executor.submit(lookup, ydl)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel() # Drops it if it's still waiting for the worker
+        raise VideoInfoError(f"yt-dlp did not return any info within {timeout} seconds.")
+
+def yt_dlp_base_command():
+    """
+    Returns the start of a yt-dlp command line carrying the same session settings
+    (extractor args, cookies, headers) as the in-process instance from get_info_downloader().
+    """
+    command = ["yt-dlp"]
+    for extractor, extractor_args in YT_DLP_EXTRACTOR_ARGS.items():
+        command += ["--extractor-args", f"{extractor}:" + ";".join(f"{key}={','.join(values)}" for key, values in extractor_args.items())]
+    if YT_DLP_COOKIE_FILE:
+        command += ["--cookies", YT_DLP_COOKIE_FILE]
+    for header, value in YT_DLP_HTTP_HEADERS.items():
+        command += ["--add-headers", f"{header}:{value}"]
+    return command
+
+@st.cache_data(ttl=MEMORY_CACHE_TTL, show_spinner=False)
+@METADATA_CACHE.memoize(expire=METADATA_CACHE_TTL)
 def get_playlist_info(playlist_url):
     """
     Uses yt-dlp to get information about all videos in a playlist.
     Returns a list of dictionaries, where each dictionary contains
     info about a video (id, title, url, filename_playlist_index).
+    Raises VideoInfoError on failure; successful results are cached per URL in memory and on disk.
     """
-    command = [
-        "yt-dlp",
-        "--flat-playlist",    # Don't extract info from video pages, just list them
-        "--print-json",       # Output info as JSON
-        playlist_url
-    ]
-    st.info(f"Fetching playlist info with command: {' '.join(command)}")
     try:
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8')
-        stdout, stderr = process.communicate(timeout=60) # Added timeout
-
-        if process.returncode != 0:
-            st.error(f"Error fetching playlist info (yt-dlp exited with {process.returncode}):")
-            if stderr: st.error(f"stderr: {stderr}")
-            if stdout: st.warning(f"stdout: {stdout}") # Sometimes errors are on stdout
-            return []
-
-        videos_info = []
-        if not stdout.strip():
-            st.warning("No output from yt-dlp for playlist info. The playlist might be empty or private.")
-            return []
-
-        for i, line in enumerate(stdout.strip().split('\n')):
-            if line:
-                try:
-                    video_data = json.loads(line)
-                    # Use yt-dlp's playlist_index if available, otherwise use enumeration (1-based)
-                    # yt-dlp's playlist_index is usually 1-based.
-                    actual_playlist_index_for_naming = video_data.get("playlist_index")
-                    if actual_playlist_index_for_naming is None:
-                        actual_playlist_index_for_naming = i + 1 # Fallback to 1-based enumeration
-
-                    videos_info.append({
-                        "id": video_data.get("id"),
-                        "title": video_data.get("title", f"Untitled Video {actual_playlist_index_for_naming}"),
-                        "url": f"https://www.youtube.com/watch?v={video_data.get('id')}", # Construct direct video URL
-                        "filename_playlist_index": actual_playlist_index_for_naming
-                    })
-                except json.JSONDecodeError as e:
-                    st.warning(f"Could not parse video info line: {line}. Error: {e}")
-        return videos_info
-    except subprocess.TimeoutExpired:
-        st.error("Fetching playlist info timed out. The playlist might be very large or there could be network issues.")
-        return []
+        info = run_info_lookup(lambda ydl: ydl.extract_info(playlist_url, download=False), timeout=60)
+    except VideoInfoError:
+        raise
     except Exception as e:
-        st.error(f"An exception occurred while fetching playlist info: {str(e)}")
-        return []
+        raise VideoInfoError(f"An exception occurred while fetching playlist info: {str(e)}")
+
+    entries = [entry for entry in (info or {}).get("entries") or [] if entry]
+    if not entries:
+        raise VideoInfoError("No entries returned by yt-dlp for playlist info. The playlist might be empty or private.")
+
+    videos_info = []
+    for i, video_data in enumerate(entries):
+        # Use yt-dlp's playlist_index if available, otherwise use enumeration (1-based)
+        # yt-dlp's playlist_index is usually 1-based.
+        actual_playlist_index_for_naming = video_data.get("playlist_index")
+        if actual_playlist_index_for_naming is None:
+            actual_playlist_index_for_naming = i + 1 # Fallback to 1-based enumeration
 
+        videos_info.append({
+            "id": video_data.get("id"),
+            "title": video_data.get("title", f"Untitled Video {actual_playlist_index_for_naming}"),
+            "url": f"https://www.youtube.com/watch?v={video_data.get('id')}", # Construct direct video URL
+            "filename_playlist_index": actual_playlist_index_for_naming
+        })
+    return videos_info
+
+@st.cache_data(ttl=MEMORY_CACHE_TTL, show_spinner=False)
+@METADATA_CACHE.memoize(expire=METADATA_CACHE_TTL)
 def get_single_video_info(video_url):
     """
     Uses yt-dlp to get information about a single video.
     Returns a dictionary with video info (id, title, url).
+    Raises VideoInfoError on failure; successful results are cached per URL in memory and on disk.
     """
-    command = [
-        "yt-dlp",
-        "--print-json",
-        video_url
-    ]
-    st.info(f"Fetching single video info with command: {' '.join(command)}")
+    def lookup(ydl):
+        # Only id and title are needed, so take the extractor's raw result (process=False)
+        # and skip format selection and the rest of yt-dlp's info post-processing
+        video_data = ydl.extract_info(video_url, download=False, process=False)
+        if video_data and video_data.get("_type") in ("url", "url_transparent"):
+            # Redirect-style results (e.g. short links) only carry the target URL, so follow
+            # it with full processing, which extract_flat="in_playlist" lets resolve
+            video_data = ydl.extract_info(video_url, download=False)
+        return video_data
+
     try:
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8')
-        stdout, stderr = process.communicate(timeout=30) # Added timeout
+        video_data = run_info_lookup(lookup, timeout=30)
+    except VideoInfoError:
+        raise
+    except Exception as e:
+        raise VideoInfoError(f"An exception occurred while fetching single video info: {str(e)}")
 
-        if process.returncode != 0:
-            st.error(f"Error fetching video info (yt-dlp exited with {process.returncode}):")
-            if stderr: st.error(f"stderr: {stderr}")
-            if stdout: st.warning(f"stdout: {stdout}")
-            return None
+    if not video_data or not video_data.get("id"):
+        raise VideoInfoError("No info returned by yt-dlp for single video.")
+    return {
+        "id": video_data.get("id"),
+        "title": video_data.get("title", "Untitled Video"),
+        "url": video_url # Original URL is fine here
+    }
+
+def kill_process_group(process):
+    """
+    SIGKILLs a yt-dlp process started with start_new_session=True together with everything
+    it spawned (e.g. ffmpeg), so nothing keeps running or holding partial files after a timeout.
+    Windows has no process groups to signal, so there only yt-dlp itself is killed.
+    """
+    if not hasattr(os, "killpg"):
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass # Already exited
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass # The whole group has already exited
 
-        if not stdout.strip():
-            st.warning("No output from yt-dlp for single video info.")
+async def fetch_video_details_async(video_url, format_selector, semaphore):
+    """
+    Looks up duration, resolution and approximate size of the selected format for one video
+    in its own yt-dlp process. Returns a dict, or None if the lookup failed.
+    """
+    command = yt_dlp_base_command() + [
+        "-O", "%(.{id,duration_string,resolution,filesize_approx})j", # Only the fields we show
+        "-f", format_selector,
+        video_url
+    ]
+    async with semaphore:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True
+            )
+        except OSError: # e.g. yt-dlp is not installed or not on PATH
             return None
-        video_data = json.loads(stdout)
-        return {
-            "id": video_data.get("id"),
-            "title": video_data.get("title", "Untitled Video"),
-            "url": video_url # Original URL is fine here
-        }
-    except subprocess.TimeoutExpired:
-        st.error("Fetching single video info timed out.")
-        return None
-    except json.JSONDecodeError as e:
-        st.error(f"Could not parse single video JSON: {stdout}. Error: {e}")
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), timeout=60)
+        except asyncio.TimeoutError:
+            kill_process_group(process)
+            await process.wait()
+            return None
+
+    if process.returncode != 0 or not stdout.strip():
         return None
-    except Exception as e:
-        st.error(f"An exception occurred while fetching single video info: {str(e)}")
+    try:
+        return json_loads(stdout.strip().splitlines()[-1])
+    except ValueError:
         return None
 
-def download_video_yt_dlp(video_url, download_path=".", playlist_index_for_filename=None):
+def get_videos_details(video_urls, format_selector, on_video_details=None):
+    """
+    Fetches details for several videos concurrently (at most DETAILS_FETCH_CONCURRENCY yt-dlp
+    processes at a time, to stay clear of YouTube's rate limiting).
+    Returns a list aligned with video_urls, with None where a lookup failed. on_video_details,
+    if given, is called with (index, details) as soon as each lookup has finished.
+    """
+    async def fetch_details(index, video_url, semaphore):
+        video_details = await fetch_video_details_async(video_url, format_selector, semaphore)
+        if on_video_details is not None:
+            on_video_details(index, video_details)
+        return video_details
+
+    async def gather_details():
+        semaphore = asyncio.Semaphore(DETAILS_FETCH_CONCURRENCY)
+        return await asyncio.gather(*(fetch_details(index, video_url, semaphore) for index, video_url in enumerate(video_urls)))
+    return asyncio.run(gather_details())
+
+def fetch_details_and_update(video_details, details_pending, videos, format_selector):
+    """
+    Details worker: looks up details for videos, a list of (video_id, video_url), and writes each
+    result into video_details as soon as it arrives, tagged with the format it was looked up for.
+    Lookups that failed are stored as {"failed": True}. video_details and details_pending are the
+    session's own dict and set, like download_status for run_and_update; every finished video
+    is removed from details_pending.
+    """
+    def record_details(index, details):
+        video_id = videos[index][0]
+        video_details[video_id] = {**(details or {"failed": True}), "format_selector": format_selector}
+        details_pending.discard(video_id)
+
+    try:
+        get_videos_details([video_url for _, video_url in videos], format_selector, on_video_details=record_details)
+    finally:
+        details_pending.clear() # Nothing is left running, even if the lookups raised
+
+def run_yt_dlp(command, timeout=600, on_stdout_line=None):
+    """
+    Runs a yt-dlp command and returns (returncode, stdout_lines, stderr_lines), with the
+    lines as undecoded bytes. stdout and stderr are drained together by two reader threads, so
+    a full stderr pipe can't stall yt-dlp while we are still reading stdout. on_stdout_line,
+    if given, is called with each stdout line as soon as it arrives. Kills the process and
+    raises subprocess.TimeoutExpired once timeout seconds have passed (see kill_process_group).
+    """
+    # Own session / process group, so a timeout can take down yt-dlp's children as well.
+    # The large buffer lets each reader pick up many lines per read instead of one at a time.
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=65536, start_new_session=True)
+    stdout_lines, stderr_lines = [], []
+
+    def drain(stream, lines, on_line):
+        with stream:
+            for raw_line in stream:
+                line = raw_line.strip()
+                if line:
+                    lines.append(line)
+                    if on_line is not None:
+                        on_line(line)
+
+    readers = [
+        threading.Thread(target=drain, args=(process.stdout, stdout_lines, on_stdout_line), daemon=True),
+        threading.Thread(target=drain, args=(process.stderr, stderr_lines, None), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    try:
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_group(process)
+        process.wait()
+        for reader in readers:
+            reader.join(timeout=5) # A child that outlived the kill may still hold the pipes open
+        raise
+    for reader in readers:
+        reader.join()
+    return returncode, stdout_lines, stderr_lines
+
+def last_output_line(lines):
+    """Decodes the last line collected by run_yt_dlp, for error messages."""
+    return lines[-1].decode("utf-8", errors="replace") if lines else "no output"
+
+def yt_dlp_failure(message, command):
+    """Builds the DownloadError for a failed yt-dlp run; the command line is only rendered in DEBUG mode."""
+    if DEBUG:
+        message += f" (yt-dlp command: {shlex.join(command)})"
+    return DownloadError(message)
+
+def download_video_yt_dlp(video_url, download_path=".", format_selector=FORMAT_PRESETS[DEFAULT_FORMAT_PRESET]):
     """
     Downloads a single video using yt-dlp to the specified download_path on the server.
-    Returns the full path to the downloaded file or None if download failed.
+    Returns the full path to the downloaded file; raises DownloadError if the download failed.
+    Runs on a download worker thread, so it reports problems by raising instead of calling st.*.
     """
     if not os.path.exists(download_path):
         try:
-            os.makedirs(download_path)
+            os.makedirs(download_path, exist_ok=True)
         except OSError as e:
-            st.error(f"Failed to create download directory {download_path}: {e}")
-            return None
+            raise DownloadError(f"Failed to create download directory {download_path}: {e}")
 
-    # Construct the output template for yt-dlp
+    # Format: "Video Title.mp4" (playlist videos go through download_playlist_yt_dlp instead)
     # yt-dlp handles sanitization of %(title)s and determines %(ext)s
-    if playlist_index_for_filename is not None:
-        # Format: "1 - Video Title.mp4"
-        output_template_str = f"{playlist_index_for_filename} - %(title)s.%(ext)s"
-    else:
-        # Format: "Video Title.mp4"
-        output_template_str = "%(title)s.%(ext)s"
-
-    # Full path for the output template
-    full_output_template = os.path.join(download_path, output_template_str)
+    full_output_template = os.path.join(download_path, "%(title)s.%(ext)s")
 
-    command = [
-        "yt-dlp",
+    command = yt_dlp_base_command() + [
         "-o", full_output_template, # Output template (path + filename format)
         "--no-simulate",            # Ensure it actually downloads
-        "--print", "filename",      # Print the final filename to stdout
-        # "--progress",             # Optional: show progress in console (not easily captured by Streamlit live)
-        # "-f", "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best", # Example format selection
+        "--print", f"after_move:{FILEPATH_MARKER}%(filepath)s", # Print the final path once post-processing is done
+        "-f", format_selector,      # See FORMAT_PRESETS
         video_url
     ]
 
-    st.info(f"Attempting to download: {video_url}")
-    st.caption(f"yt-dlp command: {' '.join(command)}") # For debugging
+    downloaded_file_paths = []
+
+    def record_downloaded_file(line):
+        # Only the marked line is the final file; anything else yt-dlp prints is ignored
+        if line.startswith(FILEPATH_MARKER.encode()):
+            downloaded_file_paths.append(os.fsdecode(line[len(FILEPATH_MARKER):]))
 
     try:
-        # Using text=True for easier stdout/stderr handling
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8')
-        # Stream output for better feedback (optional, more complex for live UI updates)
-        stdout_lines = []
-        stderr_lines = []
-
-        # Read stdout line by line
-        for line in iter(process.stdout.readline, ''):
-            line = line.strip()
-            if line:
-                stdout_lines.append(line)
-                # st.write(f"dl out: {line}") # For live debug, can be noisy
-        process.stdout.close()
-
-        # Read stderr
-        for line in iter(process.stderr.readline, ''):
-            line = line.strip()
-            if line:
-                stderr_lines.append(line)
-                # st.write(f"dl err: {line}") # For live debug
-        process.stderr.close()
-
-        process.wait(timeout=600) # Wait for the download to complete (e.g., 10 minutes timeout)
-        
-        stdout_full = "\n".join(stdout_lines)
-        stderr_full = "\n".join(stderr_lines)
-
-        if process.returncode == 0 and stdout_lines:
-            # yt-dlp --print filename might output other info if remuxing.
-            # The actual filename is usually the last non-empty line of stdout.
-            downloaded_file_path = stdout_lines[-1]
-            if os.path.exists(downloaded_file_path):
-                st.success(f"Server download complete: {os.path.basename(downloaded_file_path)}")
-                return downloaded_file_path
-            else:
-                st.error(f"yt-dlp reported success, but file not found: {downloaded_file_path}")
-                if stdout_full: st.info(f"yt-dlp stdout:\n{stdout_full}")
-                if stderr_full: st.warning(f"yt-dlp stderr:\n{stderr_full}")
-                return None
-        else:
-            st.error(f"Download failed for {video_url} (yt-dlp exit code: {process.returncode}).")
-            if stdout_full: st.info(f"yt-dlp stdout:\n{stdout_full}")
-            if stderr_full: st.warning(f"yt-dlp stderr:\n{stderr_full}")
-            return None
+        returncode, _, stderr_lines = run_yt_dlp(command, timeout=600, on_stdout_line=record_downloaded_file) # e.g., 10 minutes timeout
     except subprocess.TimeoutExpired:
-        st.error(f"Download timed out for {video_url}. The video might be too large or network slow.")
-        # Attempt to kill the process if it's still running
-        if process.poll() is None: # Check if process is still running
-            process.kill()
-            st.warning("yt-dlp process was killed due to timeout.")
-        return None
+        raise yt_dlp_failure(f"Download timed out for {video_url}. The video might be too large or network slow.", command)
+
+    if returncode != 0 or not downloaded_file_paths:
+        raise yt_dlp_failure(f"yt-dlp exit code {returncode}: {last_output_line(stderr_lines)}", command)
+
+    downloaded_file_path = downloaded_file_paths[0]
+    if not os.path.exists(downloaded_file_path):
+        raise yt_dlp_failure(f"yt-dlp reported success, but file not found: {downloaded_file_path}", command)
+    return downloaded_file_path
+
+def download_playlist_yt_dlp(playlist_url, download_path=".", playlist_items=None, on_video_done=None, format_selector=FORMAT_PRESETS[DEFAULT_FORMAT_PRESET]):
+    """
+    Downloads a playlist with a single yt-dlp process to the specified download_path on the server.
+    playlist_items optionally restricts the download to the given (1-based) playlist indices, and
+    on_video_done(video_id, file_path) is called as soon as each video has been downloaded.
+    Returns a dict mapping video id to the full path of its downloaded file; raises DownloadError
+    if nothing could be downloaded. Runs on a download worker thread, like download_video_yt_dlp.
+    """
+    if not os.path.exists(download_path):
+        try:
+            os.makedirs(download_path, exist_ok=True)
+        except OSError as e:
+            raise DownloadError(f"Failed to create download directory {download_path}: {e}")
+
+    # Format: "1 - Video Title.mp4" (%(playlist_index)d keeps the index unpadded)
+    full_output_template = os.path.join(download_path, "%(playlist_index)d - %(title)s.%(ext)s")
+
+    # One process per batch: yt-dlp reuses its connections to YouTube across the whole batch
+    command = yt_dlp_base_command() + [
+        "-o", full_output_template,
+        "--yes-playlist",                                 # Download the playlist even for watch?v=...&list=... URLs
+        "--no-simulate",                                  # --print implies simulate otherwise
+        "--print", "after_move:" + FILEPATH_MARKER + "%(.{id,filepath})j", # One marked {"id": ..., "filepath": ...} line per finished video
+        "-f", format_selector,                            # See FORMAT_PRESETS
+    ]
+    if playlist_items:
+        command += ["--playlist-items", ",".join(str(item) for item in playlist_items)]
+    command.append(playlist_url)
+
+    downloaded_files = {}
+
+    def record_downloaded_file(line):
+        # yt-dlp iterates the playlist itself; each finished video shows up as one marked JSON line,
+        # parsed straight from the bytes read off the pipe
+        if not line.startswith(FILEPATH_MARKER.encode()):
+            return # Not one of our --print lines
+        try:
+            video_data = json_loads(line[len(FILEPATH_MARKER):])
+        except ValueError:
+            return
+        downloaded_file_path = video_data.get("filepath") if isinstance(video_data, dict) else None
+        if downloaded_file_path and os.path.exists(downloaded_file_path):
+            downloaded_files[video_data.get("id")] = downloaded_file_path
+            if on_video_done is not None:
+                on_video_done(video_data.get("id"), downloaded_file_path)
+
+    try:
+        returncode, _, stderr_lines = run_yt_dlp(command, timeout=600 * len(playlist_items or [None]), on_stdout_line=record_downloaded_file)
+    except subprocess.TimeoutExpired:
+        if not downloaded_files:
+            raise yt_dlp_failure(f"Download timed out for {playlist_url}.", command)
+        return downloaded_files
+
+    # yt-dlp keeps going after a failed entry, so a non-zero exit code can still come with some files
+    if not downloaded_files:
+        raise yt_dlp_failure(f"yt-dlp exit code {returncode}: {last_output_line(stderr_lines)}", command)
+    return downloaded_files
+
+@st.cache_resource
+def get_download_executor():
+    """
+    Returns the thread pool every download and details worker runs on. It is shared by all
+    sessions for the life of the server, so MAX_DOWNLOAD_WORKERS caps the yt-dlp processes the
+    server runs at once, not just the ones started from one browser tab.
+    """
+    return ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS)
+
+def run_and_update(download_status, video_ids, download_path, format_selector, video_url=None, playlist_url=None, playlist_items=None):
+    """
+    Download worker: runs a single-video or playlist-batch download and writes each result into
+    download_status as soon as it is known, so reruns only have to render the current state.
+    download_status is the session's status dict itself, since st.session_state can't be
+    reached from worker threads.
+    """
+    def mark_completed(video_id, file_path):
+        download_status[video_id] = {"status": "completed", "path": file_path}
+        # Remembered so a later visit can show the file as downloaded without re-fetching it
+        DOWNLOAD_RECORDS.set(download_record_key(video_id, format_selector, playlist_url), file_path, expire=DOWNLOAD_RECORD_TTL)
+
+    failure_msg = "Server download failed."
+    try:
+        if playlist_url is not None:
+            download_playlist_yt_dlp(playlist_url, download_path, playlist_items, on_video_done=mark_completed, format_selector=format_selector)
+        else:
+            mark_completed(video_ids[0], download_video_yt_dlp(video_url, download_path, format_selector=format_selector))
     except Exception as e:
-        st.error(f"An unexpected error occurred during download: {str(e)}")
-        return None
+        failure_msg = f"Server download failed: {e}"
+
+    # Whatever yt-dlp did not report back has failed
+    for video_id in video_ids:
+        if download_status.get(video_id, {}).get("status") == "processing":
+            download_status[video_id] = {"status": "failed", "path": failure_msg}
+
+def list_downloaded_files(download_path):
+    """
+    Returns the set of file names in download_path from a single os.scandir pass;
+    DirEntry carries the file type from the scan itself, so there is no extra stat per entry.
+    """
+    try:
+        with os.scandir(download_path) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+def read_file_on_demand(file_path):
+    """
+    Returns a zero-argument callable for st.download_button's deferred data, so a downloaded
+    file is read into memory only when the user clicks its button instead of on every rerun.
+    The whole file is still read at once on that click; this defers the read, it doesn't stream it.
+    """
+    def read_file():
+        with open(file_path, "rb") as fp:
+            return fp.read()
+    return read_file
 
 # --- Streamlit App UI ---
 
@@ -222,49 +525,142 @@ st.markdown("---")
 # Initialize session state variables
 if 'url_input' not in st.session_state:
     st.session_state.url_input = ""
+if 'url_is_playlist' not in st.session_state:
+    st.session_state.url_is_playlist = False
 if 'videos_to_process' not in st.session_state:
     st.session_state.videos_to_process = [] # List of video dicts
 if 'download_status' not in st.session_state:
-    # Stores {video_id: {"status": "pending/processing/completed/failed", "path": "filepath_or_error_msg"}}
+    # Stores {video_id: {"status": "pending/cancelled/processing/completed/failed", "path": "filepath_or_error_msg"}}
+    # Download workers write their results straight into this dict
     st.session_state.download_status = {}
+if 'video_details' not in st.session_state:
+    # Stores {video_id: {"duration_string": ..., "resolution": ..., "filesize_approx": ..., "format_selector": ...}}
+    # The details worker writes its results straight into this dict
+    st.session_state.video_details = {}
+if 'details_pending' not in st.session_state:
+    # Ids of the videos the details worker is still looking up
+    st.session_state.details_pending = set()
+EXECUTOR = get_download_executor()
+# Fetching, refreshing and cleaning all reset download_status, which the workers are still writing into
+downloads_running = any(video_status_info.get("status") == "processing" for video_status_info in list(st.session_state.download_status.values()))
+# Fetching and refreshing also reset video_details, which the details worker writes into
+details_running = bool(st.session_state.details_pending)
+
+st.sidebar.title("Download Options")
+format_preset = st.sidebar.selectbox(
+    "Format",
+    list(FORMAT_PRESETS),
+    index=list(FORMAT_PRESETS).index(DEFAULT_FORMAT_PRESET),
+    key="format_preset",
+    help="Applies to downloads started after changing it. The 1080p option needs ffmpeg."
+)
 
 # Input URL
 current_url_input = st.text_input("YouTube URL (Video or Playlist):", value=st.session_state.url_input, key="url_text_input")
+if (downloads_running or details_running) and current_url_input != st.session_state.url_input:
+    st.info("Downloads or detail lookups are still running; the new URL will be fetched once they have finished.")
 
-if st.button("🔗 Fetch Video(s) Info", key="fetch_button") or \
-   (current_url_input and current_url_input != st.session_state.url_input):
+if st.button("🔗 Fetch Video(s) Info", key="fetch_button", disabled=downloads_running or details_running) or \
+   (current_url_input and current_url_input != st.session_state.url_input and not (downloads_running or details_running)) or \
+   st.session_state.pop("refetch_requested", False):
 
     st.session_state.url_input = current_url_input
+    st.session_state.url_is_playlist = is_playlist(current_url_input) # Checked once per URL, not per row
     st.session_state.videos_to_process = [] # Reset for new URL
     st.session_state.download_status = {}   # Reset statuses
+    st.session_state.video_details = {}     # Reset details
 
     if not st.session_state.url_input:
         st.warning("Please enter a URL.")
     else:
         with st.spinner("Fetching video(s) information... 🕵️‍♂️ This might take a moment."):
-            if is_playlist(st.session_state.url_input):
+            if st.session_state.url_is_playlist:
                 st.info("Playlist URL detected. Fetching video list...")
-                videos = get_playlist_info(st.session_state.url_input)
-                if videos:
+                if DEBUG:
+                    st.info(f"Fetching playlist info with yt-dlp (in-process): {st.session_state.url_input}")
+                try:
+                    videos = get_playlist_info(canonical_playlist_url(st.session_state.url_input))
                     st.session_state.videos_to_process = videos
                     st.success(f"Found {len(videos)} videos in the playlist.")
-                else:
+                except VideoInfoError as e:
+                    st.error(str(e))
                     st.warning("Could not retrieve videos from the playlist, or the playlist is empty/private.")
             else:
                 st.info("Single video URL detected. Fetching video information...")
-                video_info = get_single_video_info(st.session_state.url_input)
-                if video_info:
+                if DEBUG:
+                    st.info(f"Fetching single video info with yt-dlp (in-process): {st.session_state.url_input}")
+                try:
+                    video_info = get_single_video_info(st.session_state.url_input)
                     # For consistency, treat single videos as a list of one
                     st.session_state.videos_to_process = [video_info]
                     st.success("Video information fetched.")
-                else:
+                except VideoInfoError as e:
+                    st.error(str(e))
                     st.warning("Could not retrieve video information.")
 
+        # Videos downloaded on an earlier visit whose files are still on the server start out completed
+        # in the currently selected format (and, for playlists, as part of this playlist)
+        existing_file_names = list_downloaded_files(DOWNLOAD_DIR)
+        record_playlist_url = canonical_playlist_url(st.session_state.url_input) if st.session_state.url_is_playlist else None
+        for index, video_data in enumerate(st.session_state.videos_to_process):
+            video_id = video_data.get("id", f"video_{index}")
+            downloaded_file_server_path = DOWNLOAD_RECORDS.get(download_record_key(video_id, FORMAT_PRESETS[format_preset], record_playlist_url))
+            if downloaded_file_server_path and os.path.basename(downloaded_file_server_path) in existing_file_names:
+                st.session_state.download_status[video_id] = {"status": "completed", "path": downloaded_file_server_path}
+        if st.session_state.download_status:
+            st.info(f"{len(st.session_state.download_status)} video(s) are already downloaded on the server.")
+
 # Display videos and download buttons
 if st.session_state.videos_to_process:
     st.markdown("---")
     st.subheader(f"📋 Videos Found ({len(st.session_state.videos_to_process)}):")
 
+    # Read once per render pass; st.session_state lookups go through Streamlit's proxy and lock
+    url_is_playlist = st.session_state.url_is_playlist
+    url_input = st.session_state.url_input
+
+    # One directory scan per rerun instead of an os.path.exists() call per completed row
+    existing_file_names = list_downloaded_files(DOWNLOAD_DIR)
+
+    pending_videos = [
+        (index, video_data) for index, video_data in enumerate(st.session_state.videos_to_process)
+        if st.session_state.download_status.get(video_data.get("id", f"video_{index}"), {"status": "pending"}).get("status") == "pending"
+    ]
+    if st.button(f"⬇️ Download All ({len(pending_videos)})", key="download_all", disabled=not pending_videos):
+        if url_is_playlist:
+            # Spread the queue over the workers; each batch is still a single yt-dlp process
+            for batch in (pending_videos[i::MAX_DOWNLOAD_WORKERS] for i in range(MAX_DOWNLOAD_WORKERS)):
+                if not batch:
+                    continue
+                batch_video_ids = [video_data.get("id", f"video_{index}") for index, video_data in batch]
+                # Mark as processing before submitting, so the worker's result can't be overwritten
+                for video_id in batch_video_ids:
+                    st.session_state.download_status[video_id] = {"status": "processing"}
+                EXECUTOR.submit(
+                    run_and_update,
+                    st.session_state.download_status,
+                    batch_video_ids,
+                    DOWNLOAD_DIR,
+                    FORMAT_PRESETS[format_preset],
+                    playlist_url=canonical_playlist_url(url_input), # The list get_playlist_info() numbered
+                    playlist_items=[video_data.get("filename_playlist_index", index + 1) for index, video_data in batch]
+                )
+        else:
+            index, video_data = pending_videos[0]
+            video_id = video_data.get("id", f"video_{index}")
+            st.session_state.download_status[video_id] = {"status": "processing"}
+            EXECUTOR.submit(run_and_update, st.session_state.download_status, [video_id], DOWNLOAD_DIR, FORMAT_PRESETS[format_preset], video_url=video_data.get('url'))
+        st.rerun()
+
+    if st.button("🔎 Fetch Details", key="fetch_details", disabled=details_running, help="Duration, resolution and approximate size for the selected format"):
+        videos = [(video_data.get("id", f"video_{index}"), video_data.get("url")) for index, video_data in enumerate(st.session_state.videos_to_process)]
+        # Looked up on a worker thread, like the downloads, so the page keeps updating meanwhile
+        st.session_state.details_pending.update(video_id for video_id, _ in videos)
+        EXECUTOR.submit(fetch_details_and_update, st.session_state.video_details, st.session_state.details_pending, videos, FORMAT_PRESETS[format_preset])
+        st.rerun()
+    if details_running:
+        st.caption(f"Fetching details... {len(st.session_state.details_pending)} video(s) left.")
+
     for index, video_data in enumerate(st.session_state.videos_to_process):
         video_id = video_data.get("id", f"video_{index}")
         video_title = video_data.get("title", f"Video {index+1}")
@@ -272,85 +668,101 @@ if st.session_state.videos_to_process:
         
         # Determine the playlist index for display (if applicable)
         display_prefix = ""
-        if is_playlist(st.session_state.url_input) and "filename_playlist_index" in video_data:
+        if url_is_playlist and "filename_playlist_index" in video_data:
             display_prefix = f"{video_data['filename_playlist_index']}. "
 
-        st.markdown(f"**{display_prefix}{video_title}**")
-        st.caption(f"ID: {video_id} | URL: {video_display_url}")
+        # Title, ID/URL and details go out as one markdown element per row
+        row_markdown = f"**{display_prefix}{video_title}**\n\n*ID: {video_id} · URL: {video_display_url}*"
+        video_details = st.session_state.video_details.get(video_id)
+        if video_details and video_details.get("format_selector") != FORMAT_PRESETS[format_preset]:
+            video_details = None # Looked up for another format
+        if video_details and video_details.get("failed"):
+            row_markdown += "  \n*Details unavailable.*"
+        elif video_details:
+            size = format_bytes(video_details.get("filesize_approx")) if video_details.get("filesize_approx") else "size unknown"
+            row_markdown += f"  \n*⏱️ {video_details.get('duration_string') or '?'} · 🖥️ {video_details.get('resolution') or '?'} · 💾 ~{size}*"
 
         video_status_info = st.session_state.download_status.get(video_id, {"status": "pending"})
         status = video_status_info.get("status")
         file_path_or_msg = video_status_info.get("path")
 
-        button_col, status_col = st.columns([1, 3]) # Adjusted column ratio for potentially longer button text
-
-        with button_col:
-            if status == "pending":
-                if st.button(f"▶️ Start Download", key=f"start_dl_{video_id}_{index}"): # Changed button text and key
-                    st.session_state.download_status[video_id] = {"status": "processing"}
-                    st.experimental_rerun()
-            elif status == "completed" and file_path_or_msg and os.path.exists(file_path_or_msg):
-                with open(file_path_or_msg, "rb") as fp:
+        with st.container(border=True): # The border replaces the old "---" separator
+            st.markdown(row_markdown)
+            button_col, status_col = st.columns([1, 3]) # Adjusted column ratio for potentially longer button text
+
+            with button_col:
+                if status == "pending":
+                    if st.button("✖️ Cancel", key=f"cancel_dl_{video_id}_{index}"):
+                        st.session_state.download_status[video_id] = {"status": "cancelled"}
+                        st.rerun()
+                elif status == "cancelled":
+                    if st.button("↩️ Queue Again", key=f"requeue_dl_{video_id}_{index}"):
+                        st.session_state.download_status[video_id] = {"status": "pending"}
+                        st.rerun()
+                elif status == "completed" and file_path_or_msg and os.path.basename(file_path_or_msg) in existing_file_names:
                     st.download_button(
                         label="✅ Download File",
-                        data=fp,
+                        data=read_file_on_demand(file_path_or_msg), # Only read from disk when the button is clicked
                         file_name=os.path.basename(file_path_or_msg), # Use the actual filename from server
-                        mime="application/octet-stream", # Generic binary file
+                        mime=mimetypes.guess_type(file_path_or_msg)[0] or "application/octet-stream",
                         key=f"serve_{video_id}_{index}"
                     )
-            elif status == "processing":
-                st.button("⏳ Processing...", disabled=True, key=f"proc_{video_id}_{index}")
-
-
-        with status_col:
-            if status == "processing":
-                # This block will execute when rerun after "Start Download" is clicked
-                with st.spinner(f"Downloading '{video_title}' to server... Please wait."):
-                    playlist_idx_for_file = video_data.get('filename_playlist_index') if is_playlist(st.session_state.url_input) else None
-                    
-                    downloaded_file_server_path = download_video_yt_dlp(
-                        video_data.get('url'),
-                        download_path=DOWNLOAD_DIR,
-                        playlist_index_for_filename=playlist_idx_for_file
-                    )
-                    if downloaded_file_server_path and os.path.exists(downloaded_file_server_path):
-                        st.session_state.download_status[video_id] = {"status": "completed", "path": downloaded_file_server_path}
-                    else:
-                        st.session_state.download_status[video_id] = {"status": "failed", "path": "Server download failed."}
-                    st.experimental_rerun() # Rerun to update button to "Download File" or show error
-            elif status == "failed":
-                st.error(f"Failed: {file_path_or_msg or 'Unknown error'}")
-            elif status == "completed" and not (file_path_or_msg and os.path.exists(file_path_or_msg)):
-                 st.error(f"Download was marked complete, but file is missing: {file_path_or_msg}")
+                elif status == "processing":
+                    st.button("⏳ Processing...", disabled=True, key=f"proc_{video_id}_{index}")
 
 
-        st.markdown("---") # Separator for each video entry
+            with status_col:
+                if status == "processing":
+                    st.caption(f"Downloading '{video_title}' to server...")
+                elif status == "cancelled":
+                    st.caption("Skipped by \"Download All\".")
+                elif status == "failed":
+                    st.error(f"Failed: {file_path_or_msg or 'Unknown error'}")
+                elif status == "completed" and not (file_path_or_msg and os.path.basename(file_path_or_msg) in existing_file_names):
+                     st.error(f"Download was marked complete, but file is missing: {file_path_or_msg}")
 
 # Optional: Cleanup old files
 st.sidebar.title("Server Options")
-if st.sidebar.button("🧹 Clean Server Download Directory", key="clean_dir"):
+if st.sidebar.button("🔄 Refresh metadata", key="refresh_metadata", disabled=not st.session_state.url_input or downloads_running or details_running):
+    # Drop the cached info for the current URL (memory and disk) and fetch it again from YouTube
+    for info_function, info_url in ((get_playlist_info, canonical_playlist_url(st.session_state.url_input)),
+                                    (get_single_video_info, st.session_state.url_input)):
+        info_function.clear(info_url)
+        METADATA_CACHE.delete(info_function.__cache_key__(info_url))
+    st.session_state.refetch_requested = True
+    st.rerun()
+if st.sidebar.button("🗑️ Clear all cached metadata", key="clear_metadata"):
+    get_playlist_info.clear()
+    get_single_video_info.clear()
+    METADATA_CACHE.clear()
+    st.sidebar.success("Cleared the metadata cache.")
+# Deleting the directory under a running download would pull its partial files out from under yt-dlp
+if st.sidebar.button("🧹 Clean Server Download Directory", key="clean_dir", disabled=downloads_running,
+                     help="Available once the running downloads have finished." if downloads_running else None):
     if os.path.exists(DOWNLOAD_DIR):
-        cleaned_count = 0
-        error_count = 0
         with st.spinner(f"Cleaning up `{DOWNLOAD_DIR}` on the server..."):
-            for item_name in os.listdir(DOWNLOAD_DIR):
-                item_path = os.path.join(DOWNLOAD_DIR, item_name)
-                try:
-                    if os.path.isfile(item_path) or os.path.islink(item_path):
-                        os.unlink(item_path)
-                        cleaned_count += 1
-                    # Add shutil.rmtree(item_path) if you want to remove subdirectories too
-                except Exception as e:
-                    st.sidebar.error(f"Failed to delete {item_path}: {e}")
-                    error_count +=1
-        if cleaned_count > 0:
-            st.sidebar.success(f"Cleaned {cleaned_count} item(s) from `{DOWNLOAD_DIR}`.")
-        if error_count == 0 and cleaned_count == 0:
-            st.sidebar.info(f"`{DOWNLOAD_DIR}` is already empty or no files to clean.")
+            # One recursive delete (including any subdirectories yt-dlp created), then start fresh
+            shutil.rmtree(DOWNLOAD_DIR, ignore_errors=True)
+            leftover_count = 0
+            if os.path.exists(DOWNLOAD_DIR):
+                with os.scandir(DOWNLOAD_DIR) as entries:
+                    leftover_count = sum(1 for _ in entries)
+            os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        if leftover_count:
+            st.sidebar.error(f"Failed to delete {leftover_count} item(s) from `{DOWNLOAD_DIR}`.")
+        else:
+            st.sidebar.success(f"Cleaned all item(s) from `{DOWNLOAD_DIR}`.")
         # Reset download statuses as files are gone
         st.session_state.download_status = {}
-        st.experimental_rerun()
+        DOWNLOAD_RECORDS.clear()
+        st.rerun()
     else:
         st.sidebar.info(f"Directory `{DOWNLOAD_DIR}` does not exist on the server.")
 
 st.markdown(f"<div style='text-align: center; margin-top: 30px;'>App by Your Friendly AI Assistant</div>", unsafe_allow_html=True)
+
+# Keep re-rendering while any download or detail lookup is still running on the worker threads
+if st.session_state.details_pending or \
+   any(video_status_info.get("status") == "processing" for video_status_info in list(st.session_state.download_status.values())):
+    time.sleep(1)
+    st.rerun()